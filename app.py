@@ -1,8 +1,10 @@
 import streamlit as st
-from PIL import Image, ImageDraw, UnidentifiedImageError
-from inference_sdk import InferenceHTTPClient
-import os
-import tempfile
+from PIL import Image, ImageFont, ImageOps, UnidentifiedImageError
+import base64
+import io
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import cache
 
 # Disease information dictionary
 DISEASE_INFO = {
@@ -24,120 +26,314 @@ DISEASE_INFO = {
     }
 }
 
-# Initialize Roboflow client securely
-client = InferenceHTTPClient(
-    api_url="https://serverless.roboflow.com",
-    api_key=st.secrets["general"]["api_key"]
-)
+# Flattened once so the detection loop does a single lookup keyed on the int class_id
+INFO_BY_ID = {int(k): (v["name"], v["description"]) for k, v in DISEASE_INFO.items()}
+UNKNOWN_INFO = ("Unknown", "No description available.")
+
+# Loaded once and reused for every box label
+LABEL_FONT = ImageFont.load_default()
+
+# Box colour (#8B0000) as RGB, outline width, and the box count from which drawing switches from PIL to OpenCV
+BOX_COLOR = (139, 0, 0)
+BOX_WIDTH = 4
+CV2_MIN_BOXES = 5
+
+API_URL = "https://serverless.roboflow.com"
+MISSING_KEY_MESSAGE = "Roboflow API key not configured. Set [general] api_key in .streamlit/secrets.toml."
+WORKSPACE_NAME = "oreo-kfw1b"
+WORKFLOW_ID = "custom-workflow"
+
+# The model works at well under this resolution, so larger uploads are shrunk before sending
+MAX_IMAGE_SIDE = 1024
+EXIF_ORIENTATION = 0x0112
+
+# Image preprocessing threads per process
+MAX_WORKERS = 8
+
+# Images per workflow call, keeping each request body bounded
+BATCH_SIZE = 8
+
+# 4xx responses that aren't about the images in the request (auth, missing workflow, timeout, throttling)
+NON_IMAGE_STATUS_CODES = {401, 403, 404, 408, 429}
+
+
+# Initialize Roboflow client securely, once per process rather than on every rerun
+@st.cache_resource(show_spinner=False)
+def get_client():
+    # Imported here so its dependency tree loads on first inference rather than at startup
+    from inference_sdk import InferenceHTTPClient
+
+    # The key is read and checked once here; a missing key isn't cached, so fixing secrets takes effect on the next upload
+    try:
+        api_key = st.secrets.get("general", {}).get("api_key")
+    except FileNotFoundError as e:
+        # No secrets file at all; Streamlit's StreamlitSecretNotFoundError subclasses FileNotFoundError
+        raise RuntimeError(MISSING_KEY_MESSAGE) from e
+    if not api_key:
+        raise RuntimeError(MISSING_KEY_MESSAGE)
+    return InferenceHTTPClient(
+        api_url=API_URL,
+        api_key=api_key
+    )
+
+
+# Local response cache so re-submitted images skip the Roboflow round-trip
+@st.cache_resource(show_spinner=False)
+def get_cache_db():
+    return cache.get_connection()
+
+
+# Worker threads for image preprocessing, shared across reruns instead of spawned per upload batch
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def encode_image(image_bytes):
+    # The SDK accepts base64 strings, so the upload is sent as-is
+    # without re-encoding through PIL or a temp file
+    return base64.b64encode(image_bytes).decode("ascii")
+
+
+def has_predictions(output):
+    return "predictions" in output and "predictions" in output["predictions"]
+
+
+class InferenceBatchError(Exception):
+    # Raised rather than returned so st.cache_data doesn't memoize failures or unusable responses;
+    # carries the results that did come back alongside the per-image errors
+    def __init__(self, results, errors):
+        incomplete = sum(not result or not has_predictions(result[0]) for result in results)
+        super().__init__(f"Inference incomplete for {incomplete} image(s)")
+        self.results = results
+        self.errors = errors
+
+
+class OutputCountError(Exception):
+    # The workflow returned a different number of outputs than images sent, so none can be matched up
+    def __init__(self, sent, received):
+        super().__init__(f"Workflow returned {received} output(s) for {sent} image(s)")
+
+
+def is_image_error(error):
+    # Only failures a single image could cause are worth retrying image by image; a missing
+    # or rejected key, throttling, server errors and network errors would fail every retry too
+    if isinstance(error, OutputCountError):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and 400 <= status_code < 500 and status_code not in NON_IMAGE_STATUS_CODES
+
+
+def run_workflow(images_bytes, workflow_id):
+    encoded = [encode_image(image_bytes) for image_bytes in images_bytes]
+    outputs = get_client().run_workflow(
+        workspace_name=WORKSPACE_NAME,
+        workflow_id=workflow_id,
+        images={"image": encoded if len(encoded) > 1 else encoded[0]},
+        use_cache=True
+    )
+    if len(outputs) != len(images_bytes):
+        raise OutputCountError(len(images_bytes), len(outputs))
+    return outputs
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def run_inference(images_bytes, workflow_id):
+    # Memoized so Streamlit reruns don't hit the disk cache or the network;
+    # images missing from the disk cache are sent in workflow calls of up to BATCH_SIZE
+    cache_db = get_cache_db()
+    cache_keys = [cache.make_key(image_bytes, WORKSPACE_NAME, workflow_id) for image_bytes in images_bytes]
+    results = [cache.lookup(cache_db, cache_key) for cache_key in cache_keys]
+    errors = [None] * len(images_bytes)
+    retry = False
+    missing = [i for i, result in enumerate(results) if result is None]
+    for start in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[start:start + BATCH_SIZE]
+        try:
+            outputs = run_workflow([images_bytes[i] for i in chunk], workflow_id)
+        except Exception as e:
+            if len(chunk) == 1 or not is_image_error(e):
+                for i in chunk:
+                    errors[i] = e
+                continue
+            # Retry one image at a time so a single bad image doesn't fail the rest of the batch
+            outputs = []
+            for i in chunk:
+                try:
+                    outputs.append(run_workflow([images_bytes[i]], workflow_id)[0])
+                except Exception as e:
+                    errors[i] = e
+                    outputs.append(None)
+
+        # run_workflow checked there is exactly one output per image, in the order sent
+        for i, output in zip(chunk, outputs):
+            if output is not None:
+                results[i] = [output]
+                # Responses without predictions are shown but not kept, so trying again reaches Roboflow
+                if has_predictions(output):
+                    cache.store(cache_db, cache_keys[i], results[i])
+                else:
+                    retry = True
+
+    if retry or any(error is not None for error in errors):
+        raise InferenceBatchError(results, errors)
+    return results
+
+
+@st.cache_data(show_spinner=False)
+def load_css():
+    return (Path(__file__).parent / "assets" / "style.css").read_text()
+
 
 # Page setup
 st.set_page_config(page_title="🌿 Plant Disease Detection", layout="centered")
 
 # Custom CSS for leafy theme
-st.markdown("""
-    <style>
-    .stApp {
-        background: linear-gradient(rgba(255,255,255,0.3), rgba(255,255,255,0.3)),
-            url("https://i.pinimg.com/736x/ab/bc/1d/abbc1d5062585092c10bc928f099fa8e.jpg");
-        background-size: cover;
-        background-position: center;
-        background-attachment: fixed;
-    }
-    .title {
-        color: #2c6b2f;
-        font-weight: 700;
-        font-size: 3rem;
-        margin-bottom: 0.2em;
-        text-shadow: 1px 1px 2px rgba(0,0,0,0.3);
-    }
-    .subtitle {
-        color: #3a763a;
-        font-size: 1.3rem;
-        margin-bottom: 1.5em;
-        font-weight: 500;
-    }
-    .disease-info {
-        background-color: rgba(255, 255, 255, 0.95);
-        padding: 1rem 1.5rem;
-        border-radius: 10px;
-        box-shadow: 0 2px 6px rgba(44,107,47,0.25);
-        margin-bottom: 1em;
-        color: #004d00;
-    }
-    .footer {
-        font-size: 0.9rem;
-        color: #3a663a;
-        margin-top: 3rem;
-        text-align: center;
-    }
-    </style>
-""", unsafe_allow_html=True)
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 # Header
 st.markdown('<h1 class="title">🌿 Plant Disease Detection App</h1>', unsafe_allow_html=True)
 st.markdown('<h2 class="subtitle">Upload one or more plant leaf images to detect diseases.</h2>', unsafe_allow_html=True)
 
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def downscale_image(upload_bytes):
+    # Memoized on the upload so reruns skip the decode, resize and JPEG encode. Only the
+    # re-encoded JPEG is kept, or None when the upload can be sent as-is, never decoded images
+    image = Image.open(io.BytesIO(upload_bytes))
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    if max(image.size) <= MAX_IMAGE_SIDE and orientation == 1:
+        return None
+
+    # Rotated phone photos are re-encoded upright, so the preview, the boxes and the annotated image agree
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    if max(image.size) > MAX_IMAGE_SIDE:
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_image(upload_bytes):
+    # Decoding the bytes that are sent is cheap next to the resize and encode, and keeps boxes and image in step
+    image_bytes = downscale_image(upload_bytes) or upload_bytes
+    return Image.open(io.BytesIO(image_bytes)).convert("RGB"), image_bytes
+
+
+def draw_boxes(image, boxes):
+    from PIL import ImageDraw
+
+    if len(boxes) < CV2_MIN_BOXES:
+        draw = ImageDraw.Draw(image)
+        for x0, y0, x1, y1, _ in boxes:
+            draw.rectangle([(x0, y0), (x1, y1)], outline=BOX_COLOR, width=BOX_WIDTH)
+    else:
+        # Many boxes: fill the four edges in C on a numpy copy and convert back once;
+        # filled edges match the pixels of PIL's inward outline
+        import cv2
+        import numpy as np
+
+        arr = np.asarray(image).copy()
+        for x0, y0, x1, y1, _ in boxes:
+            x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+            inner = BOX_WIDTH - 1
+            cv2.rectangle(arr, (x0, y0), (x1, y0 + inner), BOX_COLOR, -1)
+            cv2.rectangle(arr, (x0, y1 - inner), (x1, y1), BOX_COLOR, -1)
+            cv2.rectangle(arr, (x0, y0), (x0 + inner, y1), BOX_COLOR, -1)
+            cv2.rectangle(arr, (x1 - inner, y0), (x1, y1), BOX_COLOR, -1)
+        image = Image.fromarray(arr)
+        draw = ImageDraw.Draw(image)
+
+    # Labels always go through PIL so both paths render them identically
+    for x0, y0, _, _, label in boxes:
+        draw.text((x0, y0 - 20), label, fill=BOX_COLOR, font=LABEL_FONT)
+    return image
+
+
+def render_error(name, message):
+    st.markdown(f"### Processing: {name}")
+    st.error(message)
+
+
+def render_upload(name, image_bytes):
+    # Already-encoded bytes go straight to the browser; only the annotated image needs a PIL encode
+    st.markdown(f"### Processing: {name}")
+    st.image(image_bytes, caption="📷 Uploaded Image", use_column_width=True)
+
+
+def render_result(image, image_bytes, result):
+    if result and has_predictions(result[0]):
+        detections = result[0]["predictions"]["predictions"]
+        if detections:
+            # Best confidence per class, so repeated detections of a disease are listed once
+            detected_diseases = {}
+            boxes = []
+
+            for pred in detections:
+                x, y, w, h = pred["x"], pred["y"], pred["width"], pred["height"]
+                class_id = pred.get("class_id")
+                confidence = pred.get("confidence", 0)
+                disease_name, disease_desc = INFO_BY_ID.get(class_id, UNKNOWN_INFO)
+                if class_id not in detected_diseases or confidence > detected_diseases[class_id][2]:
+                    detected_diseases[class_id] = (disease_name, disease_desc, confidence)
+
+                label = f"{disease_name} ({confidence*100:.1f}%)"
+                boxes.append((x - w/2, y - h/2, x + w/2, y + h/2, label))
+
+            image = draw_boxes(image, boxes)
+            st.image(image, caption="🪧 Detected Disease(s)", use_column_width=True)
+            st.markdown("### Disease Information & Care Advice:")
+
+            for name, desc, conf in detected_diseases.values():
+                st.markdown(f'<div class="disease-info"><b>{name}</b> - Confidence: {conf*100:.1f}%<br>{desc}</div>', unsafe_allow_html=True)
+        else:
+            st.success("🌿 The leaf appears to be healthy. No disease detected.")
+            st.image(image_bytes, caption="🌱 Healthy Leaf", use_column_width=True)
+    else:
+        st.warning("⚠️ Could not get a valid response. Please try again.")
+
+
 # File upload
 uploaded_files = st.file_uploader("📄 Upload one or more leaf images (jpg, jpeg, png)", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
 
 if uploaded_files:
-    for uploaded_file in uploaded_files:
-        st.markdown(f"### Processing: {uploaded_file.name}")
+    # Decoding and downscaling run in the worker pool, PIL releases the GIL for most of it
+    executor = get_executor()
+    futures = [(uf.name, executor.submit(prepare_image, uf.getvalue())) for uf in uploaded_files]
+    prepared = []
+    for name, future in futures:
         try:
-            image = Image.open(uploaded_file).convert("RGB")
-            st.image(image, caption="📷 Uploaded Image", use_column_width=True)
+            image, image_bytes = future.result()
+        except UnidentifiedImageError:
+            render_error(name, "❌ The uploaded file is not a valid image.")
+            continue
+        except Exception as e:
+            render_error(name, f"❌ Error during inference: {e}")
+            continue
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-                image.save(tmp_file.name)
-                temp_image_path = tmp_file.name
+        # Show each upload right away; its results are filled in below it once inference returns
+        slot = st.container()
+        with slot:
+            render_upload(name, image_bytes)
+        prepared.append((slot, image, image_bytes))
 
+    if prepared:
+        try:
             with st.spinner("🔍 Detecting diseases..."):
-                result = client.run_workflow(
-                    workspace_name="oreo-kfw1b",
-                    workflow_id="custom-workflow",
-                    images={"image": temp_image_path},
-                    use_cache=True
-                )
-
-            if result and "predictions" in result[0] and "predictions" in result[0]["predictions"]:
-                detections = result[0]["predictions"]["predictions"]
-                if detections:
-                    draw = ImageDraw.Draw(image)
-                    detected_diseases = set()
-
-                    for pred in detections:
-                        x, y, w, h = pred["x"], pred["y"], pred["width"], pred["height"]
-                        class_id = str(pred.get("class_id", ""))
-                        confidence = pred.get("confidence", 0)
-                        disease_name = DISEASE_INFO.get(class_id, {}).get("name", "Unknown")
-                        disease_desc = DISEASE_INFO.get(class_id, {}).get("description", "No description available.")
-                        detected_diseases.add((disease_name, disease_desc, confidence))
-
-                        label = f"{disease_name} ({confidence*100:.1f}%)"
-                        draw.rectangle(
-                            [(x - w/2, y - h/2), (x + w/2, y + h/2)],
-                            outline="#8B0000",
-                            width=4
-                        )
-                        draw.text((x - w/2, y - h/2 - 20), label, fill="#8B0000")
-
-                    st.image(image, caption="🪧 Detected Disease(s)", use_column_width=True)
-                    st.markdown("### Disease Information & Care Advice:")
-
-                    for name, desc, conf in detected_diseases:
-                        st.markdown(f'<div class="disease-info"><b>{name}</b> - Confidence: {conf*100:.1f}%<br>{desc}</div>', unsafe_allow_html=True)
-                else:
-                    st.success("🌿 The leaf appears to be healthy. No disease detected.")
-                    st.image(image, caption="🌱 Healthy Leaf", use_column_width=True)
-            else:
-                st.warning("⚠️ Could not get a valid response. Please try again.")
-
-            os.remove(temp_image_path)
-
-        except UnidentifiedImageError:
-            st.error("❌ The uploaded file is not a valid image.")
+                results = run_inference([image_bytes for _, _, image_bytes in prepared], WORKFLOW_ID)
+            errors = [None] * len(prepared)
+        except InferenceBatchError as e:
+            results, errors = e.results, e.errors
         except Exception as e:
-            st.error(f"❌ Error during inference: {e}")
+            results, errors = [None] * len(prepared), [e] * len(prepared)
+
+        # Boxes come back in the coordinates of the image that was sent, so draw on that one
+        for (slot, image, image_bytes), result, error in zip(prepared, results, errors):
+            with slot:
+                if error is not None:
+                    st.error(f"❌ Error during inference: {error}")
+                else:
+                    render_result(image, image_bytes, result)
 else:
     st.info("Please upload one or more plant leaf images to get started.")
 
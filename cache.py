@@ -0,0 +1,32 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+# Next to the app, not the working directory `streamlit run` was started from
+CACHE_PATH = Path(__file__).parent / "inference_cache.db"
+
+# One connection is shared across the script threads of every session
+_lock = threading.Lock()
+
+
+def get_connection(path=CACHE_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response JSON)")
+    return conn
+
+
+def make_key(image_bytes, workspace, workflow_id):
+    return hashlib.sha256(image_bytes + workspace.encode() + workflow_id.encode()).hexdigest()
+
+
+def lookup(conn, key):
+    with _lock:
+        row = conn.execute("SELECT response FROM cache WHERE key=?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def store(conn, key, response):
+    with _lock, conn:
+        conn.execute("INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)", (key, json.dumps(response)))